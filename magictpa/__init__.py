@@ -32,6 +32,10 @@ if not gdb.parameter("target-async"):
 	raise gdb.GdbError("Please add 'set target-async on' to your .gdbinit")
 
 import magictpa.armv7m
+from magictpa.valuefmt import field_formatters
+from magictpa.elfmap import instruction_map
+from magictpa.etmdecoder import ETMDecoder, ETMProfile
+from magictpa.tpaexport import exporters, export_rawfile
 from magictpa.tpacapture import capture
 from magictpa.tpacommands import tpa_log
 
@@ -42,7 +46,9 @@ cm3.trace_init(capture)
 def inferior_created_cb(event):
 	print "New inferior!"
 	cm3 = magictpa.armv7m.ARMv7M(event.inferior)
-	cm3.trace_init(capture)
+	cm3.trace_init(capture, tpa_formatter.value)
+	if tpa_etm.decoder:
+		cm3.trace_etm(tpa_etm.decoder)
 
 try:
 	gdb.events.created.connect(inferior_created_cb)
@@ -64,6 +70,30 @@ class ParameterTpaSpeed(gdb.Parameter):
 		return "TPA Speed is 0x%04X" % self.value
 tpa_speed = ParameterTpaSpeed()
 
+class ParameterTpaFormatter(gdb.Parameter):
+	"""If on, the TPIU formatter is enabled and trace from different
+	sources is separated by ATB ID.  This is needed to capture ETM trace
+	alongside ITM/DWT trace.
+	"""
+	def __init__(self):
+		self.set_doc = "Set TPIU formatter"
+		self.show_doc = "Show TPIU formatter"
+		gdb.Parameter.__init__(self, "tpa formatter", gdb.COMMAND_SUPPORT,
+			gdb.PARAM_BOOLEAN)
+		self.value = False
+	def get_set_string(self):
+		if not self.value and tpa_etm.decoder:
+			self.value = True
+			raise gdb.GdbError("ETM trace requires the formatter, "
+				"use 'set tpa etm off' first")
+		cm3.trace_formatter(self.value)
+		return "TPIU formatter is " + ("on" if self.value else "off")
+	def get_show_string(self, svalue):
+		if not self.value:
+			return "TPIU formatter is off"
+		return "TPIU formatter is on, " + str(capture.deframer)
+tpa_formatter = ParameterTpaFormatter()
+
 class ParameterTpaTime(gdb.Parameter):
 	"""Valid options are 'off', 'host', or 'delta'.
 	If off, no timestamp information will be logged.
@@ -101,6 +131,86 @@ class ParameterTpaTraceExceptions(gdb.Parameter):
 			return "Exception tracing is now off"
 tpa_traceexc= ParameterTpaTraceExceptions()
 
+class ParameterTpaEtm(gdb.Parameter):
+	"""If on, ETM instruction trace is decoded against the program
+	being debugged to collect per-function execution counts and coverage.
+	Requires 'set tpa formatter on'.
+	"""
+	def __init__(self):
+		self.set_doc = "Set ETM instruction trace"
+		self.show_doc = "Show ETM instruction trace"
+		gdb.Parameter.__init__(self, "tpa etm", gdb.COMMAND_SUPPORT,
+			gdb.PARAM_BOOLEAN)
+		self.value = False
+		self.decoder = None
+
+	def get_set_string(self):
+		if not self.value:
+			if self.decoder:
+				cm3.trace_etm(None)
+				self.decoder = None
+			return "ETM trace is now off"
+		if self.decoder:
+			return "ETM trace is on"
+
+		if not tpa_formatter.value:
+			self.value = False
+			raise gdb.GdbError("ETM trace requires 'set tpa formatter on'")
+		filename = gdb.current_progspace().filename
+		if not filename:
+			self.value = False
+			raise gdb.GdbError("No program file loaded")
+		imap = instruction_map(filename)
+		self.decoder = ETMDecoder(imap, ETMProfile(imap))
+		cm3.trace_etm(self.decoder)
+		return "ETM trace is now on, %d instructions in %d functions" % (
+			len(imap.insns), len(imap.functions))
+
+	def get_show_string(self, svalue):
+		if not self.decoder:
+			return "ETM trace is off"
+		st = self.decoder.stats
+		s = ("ETM trace is on, %d instructions traced, %d atoms lost, "
+			"%d unknown packets" % (st['insns'], st['lost'], st['unknown']))
+		warning = etm_warning(self.decoder)
+		if warning:
+			s += "\n" + warning
+		return s
+tpa_etm = ParameterTpaEtm()
+
+def etm_warning(decoder):
+	"""Explain an ETM decoder that hasn't seen any synchronisation"""
+	if decoder.stats['async'] and decoder.stats['isync']:
+		return None
+	return ("Warning: no ETM %s packets received, check the TPIU "
+		"formatter and ETM setup (see 'show tpa formatter')" %
+		("A-sync" if not decoder.stats['async'] else "I-sync"))
+
+class CommandTpaProfile(gdb.Command):
+	"""Show per-function profile from ETM trace.
+	Use 'tpa profile reset' to clear the counters."""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa profile", gdb.COMMAND_SUPPORT)
+
+	def invoke(self, args, from_tty):
+		if not tpa_etm.decoder:
+			raise gdb.GdbError("ETM trace is off")
+		profile = tpa_etm.decoder.profile
+		capture.lock.acquire()
+		if args.strip() == 'reset':
+			profile.reset()
+			s = None
+		else:
+			s = str(profile)
+		warning = etm_warning(tpa_etm.decoder)
+		capture.lock.release()
+		if warning:
+			print warning
+		if s:
+			print s
+
+tpa_profile = CommandTpaProfile()
+
 class CommandTpaWatch(gdb.Command):
 	"""Trace a program variable"""
 	def __init__(self):
@@ -108,8 +218,18 @@ class CommandTpaWatch(gdb.Command):
 		self.nextwatch = 1
 		self.watches = {}
 
-	def trigger(self, wp, time, action, value, pc):
-		value = gdb.Value(value).cast(wp.vartype)
+	def trigger(self, wp, time, action, value, pc, offset):
+		if offset is None:
+			# Written somewhere in the comparator's range, but the
+			# address wasn't traced
+			name = "%s+?" % wp.varname
+			value = "0x%X" % value
+		elif offset in wp.fields:
+			name, fmt = wp.fields[offset]
+			value = fmt(value)
+		else:
+			name = "%s+%d" % (wp.varname, offset)
+			value = "0x%X" % value
 		if pc:
 			sal = gdb.decode_line("*" + hex(pc))[1][0]
 			pc = "%s:%d" % (sal.symtab.filename, sal.line)
@@ -117,7 +237,7 @@ class CommandTpaWatch(gdb.Command):
 			pc = ''
 		if tpa_time.value == 'off':
 			time = ''
-		action = "%5s %s=%d" % (action, wp.varname, value)
+		action = "%5s %s=%s" % (action, name, value)
 		tpa_log.write("%s %-25s %s\n" % (time, action, pc))
 
 	def invoke(self, args, from_tty):
@@ -134,16 +254,43 @@ class CommandTpaWatch(gdb.Command):
 				else:
 					raise gdb.GdbError("unknown mode: " + i)
 
-		wp = cm3.watch(addr, size, 0x03 if samplepc else 0x02)
-		wp.connect(self.trigger)
+		fields = field_formatters(argv[0], val.type)
+		if samplepc and len(fields) > 1:
+			# Address offsets can't be traced together with the PC,
+			# so writes couldn't be attributed to a field.
+			raise gdb.GdbError("pc mode is only supported for scalars")
+
+		wp = cm3.watch(addr, size, magictpa.armv7m.DWT_FUNC_PC_DATAVALUE
+				if samplepc else magictpa.armv7m.DWT_FUNC_DATAVALUE,
+				len(fields) == 1)
 		wp.varname = argv[0]
 		wp.vartype = val.type
+		wp.fields = fields
+		wp.connect(self.trigger)
 		self.watches[self.nextwatch] = wp
 		print "%d:%s" % (self.nextwatch, wp)
 		self.nextwatch += 1
 
 tpa_watch = CommandTpaWatch()
 
+def watch_signals():
+	"""Map comparators, or (comparator, address offset) pairs for shared
+	comparators, to the names of watched variables and fields.  Also
+	returns the value formatter for each name."""
+	names = {}
+	formats = {}
+	for wp in tpa_watch.watches.values():
+		comp = wp.comparator
+		if comp.func & magictpa.armv7m.DWT_FUNC_EMITRANGE:
+			for off, (name, fmt) in wp.fields.items():
+				names[(comp.index, (wp.addr + off) & 0xFFFF)] = name
+				formats[name] = fmt
+		else:
+			names[comp.index] = wp.varname
+			if len(wp.fields) == 1:
+				formats[wp.varname] = wp.fields[0][1]
+	return names, formats
+
 class CommandTpaDelete(gdb.Command):
 	"""Remove a trace source"""
 	def __init__(self):
@@ -151,11 +298,120 @@ class CommandTpaDelete(gdb.Command):
 
 	def invoke(self, args, from_tty):
 		i = int(args)
-		tpa_watch.watches[i].connect(None)
+		tpa_watch.watches[i].release()
 		del tpa_watch.watches[i]
 
 tpa_delete = CommandTpaDelete()
 
+class CommandTpaComparators(gdb.Command):
+	"""Show DWT comparator usage"""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa comparators", gdb.COMMAND_SUPPORT)
+
+	def invoke(self, args, from_tty):
+		print cm3.comparators
+		for n, wp in sorted(tpa_watch.watches.items()):
+			print "%d:%s %s" % (n, wp.varname, wp)
+
+tpa_comparators = CommandTpaComparators()
+
+class CommandTpaExport(gdb.Command):
+	"""Stream decoded trace to a file for Perfetto or a waveform viewer.
+	Usage: tpa export (chrome|vcd) <file>
+	       tpa export off
+	Watched variables are named as they were when the export started."""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa export", gdb.COMMAND_SUPPORT)
+		self.exporter = None
+		self.sub = None
+
+	def stop(self):
+		if self.exporter:
+			capture.unsubscribe(self.sub)
+			self.exporter.close()
+			self.exporter = None
+
+	def invoke(self, args, from_tty):
+		argv = gdb.string_to_argv(args)
+		if argv == ['off']:
+			self.stop()
+			return
+		if len(argv) != 2 or argv[0] not in exporters:
+			raise gdb.GdbError("Usage: tpa export (%s) <file>" %
+				"|".join(exporters))
+		self.stop()
+		names, formats = watch_signals()
+		self.exporter = exporters[argv[0]](open(argv[1], "w"),
+			names, formats)
+		self.sub = capture.subscribe(self.exporter, self.exporter.types,
+			batch=True, gdb_thread=False)
+
+tpa_export = CommandTpaExport()
+
+class CommandTpaConvert(gdb.Command):
+	"""Convert a raw trace file for Perfetto or a waveform viewer.
+	Usage: tpa convert (chrome|vcd) <rawfile> <file>
+	The raw file must be captured with 'set tpa time delta'."""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa convert", gdb.COMMAND_SUPPORT)
+
+	def invoke(self, args, from_tty):
+		argv = gdb.string_to_argv(args)
+		if len(argv) != 3 or argv[0] not in exporters:
+			raise gdb.GdbError("Usage: tpa convert (%s) <rawfile> <file>" %
+				"|".join(exporters))
+		names, formats = watch_signals()
+		exporter = exporters[argv[0]](open(argv[2], "w"), names, formats)
+		if not export_rawfile(argv[1], exporter,
+				magictpa.armv7m.ITM_TRACE_ID if tpa_formatter.value
+				else None):
+			print "Warning: no timestamps in %s, capture with " \
+				"'set tpa time delta'" % argv[1]
+
+tpa_convert = CommandTpaConvert()
+
+class CommandTpaServe(gdb.Command):
+	"""Publish decoded trace events to local clients as JSON lines.
+	Usage: tpa serve <port>   -- TCP port on 127.0.0.1
+	       tpa serve <path>   -- Unix socket
+	       tpa serve off
+	       tpa serve          -- Show connected clients"""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa serve", gdb.COMMAND_SUPPORT)
+
+	def invoke(self, args, from_tty):
+		argv = gdb.string_to_argv(args)
+		if not argv:
+			print capture.server if capture.server else "Not serving trace"
+			return
+		if len(argv) != 1:
+			raise gdb.GdbError("Usage: tpa serve (<port>|<path>|off)")
+		if argv[0] == 'off':
+			capture.stop_server()
+			return
+		address = int(argv[0]) if argv[0].isdigit() else argv[0]
+		capture.start_server(address)
+		print capture.server
+
+tpa_serve = CommandTpaServe()
+
+class CommandTpaStats(gdb.Command):
+	"""Show trace decoder statistics"""
+	def __init__(self):
+		gdb.Command.__init__(self, "tpa stats", gdb.COMMAND_SUPPORT)
+
+	def invoke(self, args, from_tty):
+		capture.lock.acquire()
+		st = dict(capture.stats)
+		synced = capture.synced
+		capture.lock.release()
+		print "Decoder is %s" % ("synchronised" if synced else
+			"waiting for synchronisation")
+		for k in sorted(st.keys()):
+			print "%-10s %d" % (k, st[k])
+
+tpa_stats = CommandTpaStats()
+
 class CommandTpaStim(gdb.Command):
 	"""Trace ITM Stimulus"""
 	def __init__(self):
@@ -19,6 +19,9 @@
 import gdb
 import struct
 
+from tpaevents import (StimulusEvent, DataValueEvent, PCEvent,
+		AddressEvent, ExceptionEvent)
+
 class ARMv7M(object):
 	def __init__(self, inferior):
 		self._inf = inferior
@@ -29,23 +32,46 @@ class ARMv7M(object):
 		self.DWT = DWT(self._inf)
 		self.TPIU = TPIU(self._inf)
 		self.ITM = ITM(self._inf)
+		self.ETM = ETM(self._inf)
 		self.DBGMCU = DBGMCU(self._inf)
+		self.comparators = DWTComparatorPool(self)
 		self.capture = None
 		self.stimbuf = {}
+		self.stimcb = {}
+		self._stimsub = None
+		self._excsub = None
+		self._etm = None
 
-	def trace_init(self, capture):
+	def trace_init(self, capture, formatter=False):
 		"""Enable trace port in Manchester mode"""
 		self.TPIU.SPPR = TPIU_SPPR_ASYNC_MANCHESTER
 		self.TPIU.ACPR = 0x0010
 		self.TPIU.CSPSR = TPIU_CSPSR_BYTE
-		self.TPIU.FFCR = 0 # Disable formatter
 
 		self.DBGMCU.CR = (
 			DBGMCU_CR_TRACE_IOEN | DBGMCU_CR_TRACE_MODE_ASYNC
 		)
 
-		self.ITM.TCR = ITM_TCR_ITMENA | ITM_TCR_TXENA
+		# Periodic synchronisation packets let the decoder recover from
+		# lost data.  These are timed from CYCCNT.
+		self.DWT.CTRL = ((self.DWT.CTRL & ~DWT_CTRL_SYNCTAP_MASK) |
+				DWT_CTRL_CYCCNTENA | DWT_CTRL_SYNCTAP_24)
+		self.ITM.TCR = (ITM_TCR_ITMENA | ITM_TCR_SYNCENA | ITM_TCR_TXENA |
+				(ITM_TRACE_ID << ITM_TCR_TRACEBUSID_SHIFT))
 		self.capture = capture
+		self.trace_formatter(formatter)
+
+	def trace_formatter(self, enable=True):
+		"""Enable the TPIU formatter so multiple trace sources can share
+		the trace port.  ITM/DWT trace is sent with ATB ID ITM_TRACE_ID."""
+		if enable:
+			self.TPIU.FFCR = TPIU_FFCR_ENFCONT
+			self.capture.set_formatter(ITM_TRACE_ID)
+			if self._etm:
+				self.capture.add_source(ETM_TRACE_ID, self._etm)
+		else:
+			self.TPIU.FFCR = 0 # Disable formatter
+			self.capture.set_formatter(None)
 
 	def trace_time(self, enable=True):
 		if enable:
@@ -54,108 +80,318 @@ class ARMv7M(object):
 			self.ITM.TCR &= ~ITM_TCR_TSENA
 		self.capture.hold_for_time(enable)
 
-	def watch(self, addr, size, func):
-		return TraceWatch(self, addr, size, func)
+	def trace_etm(self, decoder):
+		"""Enable ETM instruction trace, routed to decoder.
+		Requires the TPIU formatter."""
+		if decoder is None:
+			self.ETM.CR |= ETM_CR_PROGBIT
+			self.ETM.CR |= ETM_CR_POWERDOWN
+			self.capture.remove_source(ETM_TRACE_ID)
+			self._etm = None
+			return
+
+		self.capture.add_source(ETM_TRACE_ID, decoder)
+		self._etm = decoder
+		self.ETM.LAR = 0xC5ACCE55
+		self.ETM.CR = ETM_CR_PROGBIT
+		for i in range(100):
+			if self.ETM.SR & ETM_SR_PROGBIT:
+				break
+		else:
+			raise gdb.GdbError("ETM did not enter programming mode")
+
+		self.ETM.TRACEIDR = ETM_TRACE_ID
+		# Trace everything: TraceEnable event always true, with an
+		# empty exclude list.
+		self.ETM.TEEVR = ETM_EVENT_ALWAYS
+		self.ETM.TECR1 = ETM_TECR1_EXCLUDE
+		self.ETM.CR = ETM_CR_ETMEN
 
-	def _exc_trace(self, dec, value, cb):
-		fnnames = {1:"entered", 2:"exited", 3:"returned to"}
-		exc = value & 0x1ff
-		fn = (value >> 12) & 3
-		if type(dec.time) is float:
-			time = "%.6f" % dec.time
+	def watch(self, addr, size, func, scalar=True):
+		return TraceWatch(self, addr, size, func, scalar)
+
+	def _exc_trace(self, ev, cb):
+		if type(ev.time) is float:
+			time = "%.6f" % ev.time
 		else:
-			time = str(dec.time)
-		cb(time, fnnames[fn], exc)
+			time = str(ev.time)
+		cb(time, ExceptionEvent.names[ev.action], ev.number)
 
 	def trace_exc(self, callback):
 		if callback is None:
 			self.DWT.CTRL &= ~DWT_CTRL_EXCTRCENA
-			self.capture.unregister_opcode(0x0E, 0xFF)
+			if self._excsub:
+				self.capture.unsubscribe(self._excsub)
+				self._excsub = None
 			return
 
 		if not callable(callback):
 			raise TypeError("Callback must be callable")
 
 		self.DWT.CTRL |= DWT_CTRL_EXCTRCENA
-		self.capture.register_opcode(0x0E, 0xFF,
-				lambda d, o, v: self._exc_trace(d, v, callback))
-
-	def _stim_trace(self, opcode, value, cb):
-		channel = opcode >> 5
-		value = chr(value)
-		self.stimbuf[channel] += value
-		if value == '\n':
-			cb(channel, self.stimbuf[channel])
-			self.stimbuf[channel] = ''
+		if self._excsub:
+			self.capture.unsubscribe(self._excsub)
+		self._excsub = self.capture.subscribe(
+				lambda ev: self._exc_trace(ev, callback), ExceptionEvent)
+
+	def _stim_trace(self, ev):
+		cb = self.stimcb.get(ev.channel)
+		if cb is None:
+			return
+		for i in range(ev.size):
+			value = chr((ev.value >> (8 * i)) & 0xFF)
+			self.stimbuf[ev.channel] += value
+			if value == '\n':
+				cb(ev.channel, self.stimbuf[ev.channel])
+				self.stimbuf[ev.channel] = ''
 
 	def trace_stim(self, channel, callback):
 		if callback is None:
 			self.ITM.TER &= ~(1 << channel)
-			self.capture.unregister_opcode((channel << 3) | 0x01, 0xFF)
+			self.stimcb.pop(channel, None)
+			if not self.stimcb and self._stimsub:
+				self.capture.unsubscribe(self._stimsub)
+				self._stimsub = None
 			return
 
 		if not callable(callback):
 			raise TypeError("Callback must be callable")
 
 		self.stimbuf[channel] = ''
+		self.stimcb[channel] = callback
 		self.ITM.TER |= 1 << channel
-		self.capture.register_opcode((channel << 3) | 0x01, 0xFF,
-				lambda d, o, v: self._stim_trace(o, v, callback))
+		if not self._stimsub:
+			self._stimsub = self.capture.subscribe(self._stim_trace,
+					StimulusEvent)
 
 
 class TraceWatch(object):
-	def __init__(self, dev, addr, size, func):
-		"""Find and set up a watchpoint comparator"""
-		found = None
-		for i in range(0, dev.DWT.numcomp):
-			if dev.DWT.FUNC[i] & 0xF == 0:
-				found = i
-				break
-		if found is None:
-			raise gdb.GdbError("no watchpoint units available")
-
+	def __init__(self, dev, addr, size, func, scalar=True):
+		"""Find and set up a watchpoint comparator.  If scalar is False
+		the watch covers several fields, which can only be told apart
+		by address packets."""
 		self._addr = addr
 		self._size = size
-		self._wp = found
+		self._func = func
+		self._scalar = scalar
+		self._dev = dev
+		self._callback = None
+		self._comp = dev.comparators.allocate(self)
 
-		dev.DWT.COMP[found] = addr
-		dev.DWT.MASK[found] = size - 1
-		dev.DWT.FUNC[found] = func
+	@property
+	def addr(self):
+		return self._addr
 
-		self._dev = dev
-		self._wp_pc = {}
+	@property
+	def comparator(self):
+		return self._comp
 
 	def connect(self, callback):
-		cap = self._dev.capture
-		if callback:
-			cap.register_opcode(0x80 | (self._wp << 4), 0xF0,
-					self._trigger)
-			cap.register_opcode(0x47 | (self._wp << 4), 0xFF,
-					self._pcsample)
-			self._callback = callback
+		self._callback = callback
+		self._comp.connect()
+
+	def release(self):
+		"""Disconnect and return the comparator to the pool"""
+		if self._comp is None:
+			return
+		self.connect(None)
+		self._dev.comparators.release(self)
+		self._comp = None
+
+	def _trigger(self, ev, pc, offset):
+		action = 'write' if ev.write else 'read'
+		if type(ev.time) is float:
+			time = "%.6f" % ev.time
 		else:
-			cap.unregister_opcode(0x80 | (self._wp << 4), 0xF0)
-			cap.unregister_opcode(0x47 | (self._wp << 4), 0xFF)
-
-	def _pcsample(self, dec, op, value):
-		self._wp_pc[(op >> 4) & 3] = value
-
-	def _trigger(self, dec, op, value):
-		wp = (op >> 4) & 3
-		pc = self._wp_pc.get(wp, None)
-		action = 'write' if op & 0x8 else 'read'
-		if type(dec.time) is float:
-			time = "%.6f" % dec.time
+			time = str(ev.time)
+		self._callback(self, time, action, ev.value, pc, offset)
+
+	def __str__(self):
+		s = ("WP comparator %d for addr 0x%X, size %d" %
+			(self._comp.index, self._addr, self._size))
+		shared = len(self._comp.watches) - 1
+		if shared:
+			s += " (shared with %d other watch%s)" % (shared,
+				"es" if shared > 1 else "")
+		return s
+
+
+def range_mask(lo, hi):
+	"""Number of low address bits to ignore to cover [lo, hi)"""
+	mask = 0
+	while (lo >> mask) != ((hi - 1) >> mask):
+		mask += 1
+	return mask
+
+class DWTComparator(object):
+	"""A DWT comparator serving one or more watches"""
+	def __init__(self, pool, index):
+		self._pool = pool
+		self.index = index
+		self.watches = []
+		self.base = 0
+		self.mask = 0
+		self.func = 0
+		self._sub = None
+		self._pc = None
+		self._offset = None
+
+	def region(self, extra=None):
+		"""Return (base, mask) covering all watches plus extra"""
+		watches = self.watches + ([extra] if extra else [])
+		lo = min(w._addr for w in watches)
+		hi = max(w._addr + w._size for w in watches)
+		mask = range_mask(lo, hi)
+		return lo & ~((1 << mask) - 1), mask
+
+	def shareable(self, watch):
+		return (watch._func == DWT_FUNC_DATAVALUE and
+			all(w._func == DWT_FUNC_DATAVALUE for w in self.watches))
+
+	def program(self):
+		dwt = self._pool._dev.DWT
+		self.base, self.mask = self.region()
+		self.func = self.watches[0]._func
+		if (len(self.watches) > 1 or not self.watches[0]._scalar or
+		    (1 << self.mask) != self.watches[0]._size):
+			if self.func == DWT_FUNC_DATAVALUE:
+				self.func |= DWT_FUNC_EMITRANGE
+		dwt.COMP[self.index] = self.base
+		dwt.MASK[self.index] = self.mask
+		dwt.FUNC[self.index] = self.func
+
+	def disable(self):
+		self._pool._dev.DWT.FUNC[self.index] = 0
+		self.func = 0
+
+	def connect(self):
+		"""Subscribe to comparator events while any watch has a callback"""
+		cap = self._pool._dev.capture
+		want = any(w._callback for w in self.watches)
+		if want == (self._sub is not None):
+			return
+		if want:
+			self._sub = cap.subscribe(self._event,
+				(DataValueEvent, PCEvent, AddressEvent))
 		else:
-			time = str(dec.time)
-		self._callback(self, time, action, value, pc)
+			cap.unsubscribe(self._sub)
+			self._sub = None
+
+	def _event(self, ev):
+		if ev.comparator != self.index:
+			return
+		if isinstance(ev, PCEvent):
+			self._pc = ev.pc
+		elif isinstance(ev, AddressEvent):
+			self._offset = ev.offset
+		else:
+			self._datavalue(ev)
+
+	def _datavalue(self, ev):
+		pc, self._pc = self._pc, None
+		offset, self._offset = self._offset, None
+		if offset is None:
+			# No address information, the comparator has a single watch.
+			# The offset is only known if the comparator covers exactly
+			# that watch and it is a scalar.
+			w = self.watches[0]
+			if w._callback:
+				exact = (w._scalar and self.base == w._addr and
+					(1 << self.mask) == w._size)
+				w._trigger(ev, pc, 0 if exact else None)
+			return
+
+		# Address offset packets only carry bits [15:0].
+		addr = (self.base & ~0xFFFF) | offset
+		if addr < self.base:
+			addr += 0x10000
+		for w in self.watches:
+			if not w._callback:
+				continue
+			if w._addr <= addr < w._addr + w._size:
+				w._trigger(ev, pc, addr - w._addr)
 
 	def __str__(self):
-		return ("WP comparator %d for addr 0x%X, size %d" %
-			(self._wp, self._addr, self._size))
+		return ("Comparator %d: 0x%08X mask %d func 0x%02X, %d watch%s" %
+			(self.index, self.base, self.mask, self.func,
+			len(self.watches), "es" if len(self.watches) != 1 else ""))
 
-	def __del__(self):
-		self._dev.DWT.FUNC[self._wp] = 0
+class DWTComparatorPool(object):
+	"""Allocate DWT comparators, sharing them between watches"""
+	def __init__(self, dev):
+		self._dev = dev
+		self._comps = [None] * dev.DWT.numcomp
+		self._maxmask = None
+
+	def _probe_maxmask(self, i):
+		"""Find the largest MASK value supported by the comparators"""
+		if self._maxmask is None:
+			self._dev.DWT.MASK[i] = 0x1F
+			self._maxmask = self._dev.DWT.MASK[i]
+			self._dev.DWT.MASK[i] = 0
+		return self._maxmask
+
+	def _free_index(self):
+		# Comparators may also be in use by GDB hardware watchpoints,
+		# so check the hardware before claiming an unused slot.
+		for i, comp in enumerate(self._comps):
+			if comp is None and self._dev.DWT.FUNC[i] & 0xF == 0:
+				return i
+		return None
+
+	def allocate(self, watch):
+		free = self._free_index()
+		best = None
+		for comp in self._comps:
+			if comp is None or not comp.shareable(watch):
+				continue
+			base, mask = comp.region(watch)
+			if mask > self._maxmask:
+				continue
+			if best is None or mask < best[1]:
+				best = (comp, mask)
+
+		if best is not None:
+			comp, mask = best
+			used = sum(w._size for w in comp.watches) + watch._size
+			# Only widen a comparator over unwatched memory if there
+			# is nothing else available.
+			if free is None or (1 << mask) <= 2 * used:
+				comp.watches.append(watch)
+				comp.program()
+				return comp
+
+		if free is None:
+			raise gdb.GdbError("no watchpoint units available")
+		if range_mask(watch._addr, watch._addr + watch._size) > \
+				self._probe_maxmask(free):
+			raise gdb.GdbError("variable too large for watchpoint unit")
+		comp = DWTComparator(self, free)
+		comp.watches.append(watch)
+		comp.program()
+		self._comps[free] = comp
+		return comp
+
+	def release(self, watch):
+		comp = watch._comp
+		comp.watches.remove(watch)
+		if comp.watches:
+			comp.program()
+		else:
+			comp.disable()
+			self._comps[comp.index] = None
+		comp.connect()
+
+	def __str__(self):
+		lines = []
+		for i, comp in enumerate(self._comps):
+			if comp is None:
+				lines.append("Comparator %d: %s" % (i,
+					"free" if self._dev.DWT.FUNC[i] & 0xF == 0
+					else "in use by another tool"))
+			else:
+				lines.append(str(comp))
+		return "\n".join(lines)
 
 
 def inferior_read_reg(inferior, addr):
@@ -216,6 +452,7 @@ class TPIU(MMIO):
 # TPIU bit definitions
 TPIU_CSPSR_BYTE = 0x1
 TPIU_SPPR_ASYNC_MANCHESTER = 0x1
+TPIU_FFCR_ENFCONT = 0x2
 
 class DWT(MMIO):
 	"""Data Watchpoint and Trace"""
@@ -237,11 +474,17 @@ class DWT(MMIO):
 		self.numcomp = self.CTRL >> 28;
 
 # DWT bit definitions
+DWT_CTRL_CYCCNTENA = 0x1
+DWT_CTRL_SYNCTAP_MASK = 0xC00
+DWT_CTRL_SYNCTAP_24 = 0x400
 DWT_CTRL_EXCTRCENA = 0x10000
 DWT_MASK_BYTE = 0x0
 DWT_MASK_HALFWORD = 0x1
 DWT_MASK_WORD = 0x3
 DWT_FUNC_FUNC_WRITE = 0x6
+DWT_FUNC_DATAVALUE = 0x2
+DWT_FUNC_PC_DATAVALUE = 0x3
+DWT_FUNC_EMITRANGE = 0x20
 
 class ITM(MMIO):
 	"""Instrumentation and Trace Macrocell"""
@@ -252,7 +495,38 @@ class ITM(MMIO):
 # ITM bit definitions
 ITM_TCR_ITMENA = 0x1
 ITM_TCR_TSENA = 0x2
+ITM_TCR_SYNCENA = 0x4
 ITM_TCR_TXENA = 0x8
+ITM_TCR_TRACEBUSID_SHIFT = 16
+# ATB ID used for ITM/DWT trace when the TPIU formatter is enabled
+ITM_TRACE_ID = 0x01
+
+class ETM(MMIO):
+	"""Embedded Trace Macrocell"""
+	regs = {
+		'CR': 0xE0041000,
+		'CCR': 0xE0041004,
+		'TRIGGER': 0xE0041008,
+		'SR': 0xE0041010,
+		'SCR': 0xE0041014,
+		'TEEVR': 0xE0041020,
+		'TECR1': 0xE0041024,
+		'FFLR': 0xE004102C,
+		'SYNCFR': 0xE00411E0,
+		'IDR': 0xE00411E4,
+		'TRACEIDR': 0xE0041200,
+		'LAR': 0xE0041FB0,
+		'LSR': 0xE0041FB4,
+	}
+# ETM bit definitions
+ETM_CR_POWERDOWN = 0x1
+ETM_CR_PROGBIT = 0x400
+ETM_CR_ETMEN = 0x800
+ETM_SR_PROGBIT = 0x2
+ETM_TECR1_EXCLUDE = 0x01000000
+ETM_EVENT_ALWAYS = 0x6F
+# ATB ID used for ETM trace through the TPIU formatter
+ETM_TRACE_ID = 0x02
 
 class DBGMCU(MMIO):
 	regs = {
@@ -0,0 +1,203 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pre-decoded Thumb instruction map of an ELF image.
+
+The map is built once from the ELF file on disk, without going through
+GDB, so it can be used by trace decoders running on the capture thread.
+"""
+
+import bisect
+import os
+import struct
+
+# Instruction kinds
+INSN_NORMAL = 0
+INSN_BRANCH = 1		# Direct branch, target known
+INSN_INDIRECT = 2	# Branch target only known from trace
+
+SHT_SYMTAB = 2
+SHF_EXECINSTR = 0x4
+STT_OBJECT = 1
+STT_FUNC = 2
+
+_cache = {}
+_symcache = {}
+
+def _sext(v, bits):
+	if v & (1 << (bits - 1)):
+		v -= 1 << bits
+	return v
+
+def decode_thumb(addr, hw1, hw2):
+	"""Return (size, kind, target) for the Thumb instruction at addr"""
+	if (hw1 >> 11) < 0x1D:
+		# 16-bit instruction
+		if (hw1 & 0xF000) == 0xD000 and ((hw1 >> 8) & 0xF) < 0xE:
+			return 2, INSN_BRANCH, addr + 4 + _sext((hw1 & 0xFF) << 1, 9)
+		if (hw1 & 0xF800) == 0xE000:
+			return 2, INSN_BRANCH, addr + 4 + _sext((hw1 & 0x7FF) << 1, 12)
+		if (hw1 & 0xF500) == 0xB100:
+			# CBZ/CBNZ
+			imm = ((hw1 >> 3) & 0x40) | ((hw1 >> 2) & 0x3E)
+			return 2, INSN_BRANCH, addr + 4 + imm
+		if (hw1 & 0xFF00) in (0x4700, 0xBD00):
+			# BX/BLX register, POP including PC
+			return 2, INSN_INDIRECT, None
+		if ((hw1 & 0xFD00) == 0x4400 and
+		    (((hw1 >> 4) & 8) | (hw1 & 7)) == 15):
+			# ADD/MOV to PC
+			return 2, INSN_INDIRECT, None
+		return 2, INSN_NORMAL, None
+
+	# 32-bit instruction
+	if (hw1 & 0xF800) == 0xF000 and (hw2 & 0x8000):
+		s = (hw1 >> 10) & 1
+		j1 = (hw2 >> 13) & 1
+		j2 = (hw2 >> 11) & 1
+		if (hw2 & 0x5000) == 0:
+			cond = (hw1 >> 6) & 0xF
+			if cond >= 0xE:
+				# Miscellaneous control instructions
+				return 4, INSN_NORMAL, None
+			imm = ((s << 20) | (j2 << 19) | (j1 << 18) |
+				((hw1 & 0x3F) << 12) | ((hw2 & 0x7FF) << 1))
+			return 4, INSN_BRANCH, addr + 4 + _sext(imm, 21)
+		if hw2 & 0x1000:
+			# B.W and BL
+			i1 = 1 ^ j1 ^ s
+			i2 = 1 ^ j2 ^ s
+			imm = ((s << 24) | (i1 << 23) | (i2 << 22) |
+				((hw1 & 0x3FF) << 12) | ((hw2 & 0x7FF) << 1))
+			return 4, INSN_BRANCH, addr + 4 + _sext(imm, 25)
+		return 4, INSN_NORMAL, None
+	if (hw1 & 0xFFD0) in (0xE890, 0xE910) and (hw2 & 0x8000):
+		# LDM including PC
+		return 4, INSN_INDIRECT, None
+	if (hw1 & 0xFFF0) in (0xF850, 0xF8D0) and (hw2 >> 12) == 15:
+		# LDR to PC
+		return 4, INSN_INDIRECT, None
+	if (hw1 & 0xFFF0) == 0xE8D0 and (hw2 & 0xFFE0) == 0xF000:
+		# TBB/TBH
+		return 4, INSN_INDIRECT, None
+	return 4, INSN_NORMAL, None
+
+def _symbols(elf):
+	"""Yield (name, value, size, info, section header) for each symbol
+	defined in a section of the ELF image"""
+	shoff, = struct.unpack_from("<L", elf, 0x20)
+	shentsize, shnum = struct.unpack_from("<HH", elf, 0x2E)
+	sections = [struct.unpack_from("<LLLLLLLLLL", elf,
+			shoff + i * shentsize) for i in range(shnum)]
+
+	for sh in sections:
+		if sh[1] != SHT_SYMTAB:
+			continue
+		strtab = sections[sh[6]]
+		for off in range(sh[4], sh[4] + sh[5], 16):
+			name, value, size, info, other, shndx = \
+				struct.unpack_from("<LLLBBH", elf, off)
+			if shndx == 0 or shndx >= len(sections):
+				continue
+			start = strtab[4] + name
+			name = elf[start:elf.index(b'\0', start)].decode()
+			yield name, value, size, info, sections[shndx]
+
+def _read_elf(filename):
+	f = open(filename, "rb")
+	try:
+		elf = f.read()
+	finally:
+		f.close()
+	if elf[:4] != b'\x7fELF' or elf[4:5] != b'\x01':
+		raise ValueError("%s is not a 32-bit ELF file" % filename)
+	return elf
+
+class InstructionMap(object):
+	"""Thumb instructions of all functions in an ELF file.
+
+	insns maps each instruction address to (size, kind, target, function).
+	functions maps function names to their instruction count.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.insns = {}
+		self.functions = {}
+		self._load(_read_elf(filename))
+
+	def _load(self, elf):
+		# Padding so a 16-bit instruction at the end can be read as a pair
+		elf += b'\0\0'
+		funcs = []
+		mapsyms = []
+		for name, value, size, info, sec in _symbols(elf):
+			if not sec[2] & SHF_EXECINSTR:
+				continue
+			if name.startswith(('$t', '$d', '$a')):
+				mapsyms.append((value, name[:2] == '$d'))
+			elif info & 0xF == STT_FUNC and size:
+				funcs.append((value & ~1, size, name, sec))
+		mapsyms.sort()
+		mapaddrs = [a for a, d in mapsyms]
+
+		for start, size, name, sec in funcs:
+			# Skip literal pools, marked by $d mapping symbols
+			data = mapsyms[bisect.bisect_left(mapaddrs, start):
+					bisect.bisect_left(mapaddrs, start + size)]
+			isdata = False
+			count = 0
+			addr = start
+			while addr < start + size:
+				while data and data[0][0] <= addr:
+					isdata = data.pop(0)[1]
+				if isdata:
+					addr = data[0][0] if data else start + size
+					continue
+				off = sec[4] + addr - sec[3]
+				hw1, hw2 = struct.unpack_from("<HH", elf, off)
+				size_, kind, target = decode_thumb(addr, hw1, hw2)
+				self.insns[addr] = (size_, kind, target, name)
+				count += 1
+				addr += size_
+			self.functions[name] = count
+
+def instruction_map(filename):
+	"""Return the InstructionMap for filename, reusing a cached copy if
+	the file hasn't changed."""
+	mtime = os.stat(filename).st_mtime
+	m = _cache.get(filename)
+	if m is None or m[0] != mtime:
+		m = (mtime, InstructionMap(filename))
+		_cache[filename] = m
+	return m[1]
+
+def symbol_table(filename):
+	"""Map addresses of all data objects and functions in filename to
+	their names, reusing a cached copy if the file hasn't changed."""
+	mtime = os.stat(filename).st_mtime
+	m = _symcache.get(filename)
+	if m is None or m[0] != mtime:
+		symtab = {}
+		for name, value, size, info, sec in _symbols(_read_elf(filename)):
+			if info & 0xF == STT_FUNC:
+				symtab[value & ~1] = name
+			elif info & 0xF == STT_OBJECT:
+				symtab[value] = name
+		m = (mtime, symtab)
+		_symcache[filename] = m
+	return m[1]
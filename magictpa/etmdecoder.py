@@ -0,0 +1,194 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from elfmap import INSN_BRANCH, INSN_INDIRECT
+
+class ETMProfile(object):
+	"""Per-function instruction counts and coverage from ETM trace"""
+	def __init__(self, imap):
+		self.imap = imap
+		self.reset()
+
+	def reset(self):
+		self.counts = {}
+		self.covered = {}
+
+	def executed(self, addr, func):
+		self.counts[func] = self.counts.get(func, 0) + 1
+		self.covered.setdefault(func, set()).add(addr)
+
+	def __str__(self):
+		lines = ["%-32s %12s %9s" % ("Function", "Instructions", "Coverage")]
+		for func, count in sorted(self.counts.items(),
+				key=lambda x: x[1], reverse=True):
+			total = self.imap.functions.get(func, 0)
+			cov = 100.0 * len(self.covered[func]) / total if total else 0
+			lines.append("%-32s %12d %8.1f%%" % (func, count, cov))
+		return "\n".join(lines)
+
+class ETMDecoder(object):
+	"""Decoder for ETMv3 instruction trace from Cortex-M3/M4.
+
+	Program flow is reconstructed by following P-header atoms through the
+	pre-decoded instruction map.  Indirect branch targets are taken from
+	branch address packets.  Executed instructions are counted in profile.
+	"""
+	IDLE = 0
+	ASYNC = 1
+	ISYNC = 2
+	BRANCH = 3
+	BRANCH_EXC = 4
+	TIMESTAMP = 5
+
+	def __init__(self, imap, profile):
+		self.imap = imap
+		self.profile = profile
+		self._state = ETMDecoder.ASYNC
+		self._synced = False
+		self._zeros = 0
+		self._addr = None
+		self._lastbranch = 0
+		self.stats = {
+			'insns': 0,
+			'lost': 0,
+			'unknown': 0,
+			'async': 0,
+			'isync': 0,
+		}
+
+	def decode(self, s):
+		for c in s:
+			self.decode_byte(c)
+
+	def decode_byte(self, c):
+		if c == 0x00 and self._state in (ETMDecoder.IDLE, ETMDecoder.ASYNC):
+			# Possible A-sync: five or more zeros then 0x80
+			self._zeros += 1
+			return
+		if self._zeros:
+			zeros, self._zeros = self._zeros, 0
+			if zeros >= 5 and c == 0x80:
+				self.stats['async'] += 1
+				self._synced = True
+				self._state = ETMDecoder.IDLE
+				return
+		if not self._synced:
+			return
+
+		if self._state == ETMDecoder.IDLE:
+			self._header(c)
+		elif self._state == ETMDecoder.ISYNC:
+			self._bytes.append(c)
+			if len(self._bytes) == 5:
+				# Information byte then address, no context ID
+				b = self._bytes
+				self._addr = (b[1] | (b[2] << 8) | (b[3] << 16) |
+						(b[4] << 24)) & ~1
+				self._lastbranch = self._addr
+				self.stats['isync'] += 1
+				self._state = ETMDecoder.IDLE
+		elif self._state == ETMDecoder.BRANCH:
+			self._bytes.append(c)
+			if not c & 0x80 or len(self._bytes) == 5:
+				self._branch()
+		elif self._state == ETMDecoder.BRANCH_EXC:
+			if not c & 0x80:
+				self._state = ETMDecoder.IDLE
+		elif self._state == ETMDecoder.TIMESTAMP:
+			if not c & 0x80:
+				self._state = ETMDecoder.IDLE
+
+	def _header(self, c):
+		if c & 0x01:
+			self._bytes = [c]
+			if c & 0x80:
+				self._state = ETMDecoder.BRANCH
+			else:
+				self._branch()
+		elif c & 0x83 == 0x80:
+			# P-header format 1: E atoms followed by an optional N atom
+			for i in range((c >> 2) & 0xF):
+				self._atom(True)
+			if c & 0x40:
+				self._atom(False)
+		elif c & 0xF3 == 0x82:
+			# P-header format 2: two atoms
+			self._atom(not c & 0x08)
+			self._atom(not c & 0x04)
+		elif c == 0x08:
+			self._bytes = []
+			self._state = ETMDecoder.ISYNC
+		elif c in (0x42, 0x46):
+			self._state = ETMDecoder.TIMESTAMP
+		elif c in (0x0C, 0x66, 0x76, 0x7E):
+			# Trigger, ignore, exception exit, exception entry
+			pass
+		else:
+			self.stats['unknown'] += 1
+
+	def _branch(self):
+		"""Handle a complete branch address packet"""
+		b = self._bytes
+		n = len(b)
+		exc = False
+		v = (b[0] >> 1) & 0x3F
+		bits = 6
+		for i in range(1, n):
+			if i == 4:
+				v |= (b[4] & 0x0F) << bits
+				bits += 4
+				exc = bool(b[4] & 0x40)
+			elif i == n - 1:
+				# Last byte, bit 6 flags exception information
+				v |= (b[i] & 0x3F) << bits
+				bits += 6
+				exc = bool(b[i] & 0x40)
+			else:
+				v |= (b[i] & 0x7F) << bits
+				bits += 7
+		# Unsent address bits are the same as the last branch address
+		mask = (1 << (bits + 1)) - 1
+		self._addr = (self._lastbranch & ~mask) | ((v << 1) & mask)
+		self._lastbranch = self._addr
+		self._state = ETMDecoder.BRANCH_EXC if exc else ETMDecoder.IDLE
+
+	def _atom(self, executed):
+		addr = self._addr
+		if addr is None:
+			self.stats['lost'] += 1
+			return
+		insn = self.imap.insns.get(addr)
+		if insn is None:
+			# Outside the image, wait for the next address
+			self._addr = None
+			self.stats['lost'] += 1
+			return
+		size, kind, target, func = insn
+		self.stats['insns'] += 1
+		if not executed:
+			# Condition code failed
+			self._addr = addr + size
+			return
+		self.profile.executed(addr, func)
+		if kind == INSN_BRANCH:
+			self._addr = target
+		elif kind == INSN_INDIRECT:
+			# Target follows in a branch address packet
+			self._addr = None
+		else:
+			self._addr = addr + size
@@ -20,13 +20,20 @@ import gdb
 import usb.core
 import usb.util
 import threading
+import errno
+import socket
 import sys
 
 from tpadecoder import TPADecoder
+from tpadeframer import TPIUDeframer
+from tpaserver import TraceServer
 
 def printopcode(dec, opcode, param, s):
 	print s
 
+def printresync(dec, opcode, param):
+	print "RESYNC! (%d bytes discarded)" % param
+
 def check_serial(dev, serial):
 	if not dev.iSerialNumber:
 		return False
@@ -51,14 +58,71 @@ class TPACapture(threading.Thread, TPADecoder):
 
 		self.lock = threading.RLock()
 		self.rawfile = None
+		self.deframer = TPIUDeframer()
+		self.formatter = False
+		self._itm_id = None
+		self.server = None
+		self._serversub = None
 
 		self.register_opcode(0x70, 0xFF, printopcode, "OVERFLOW!")
+		self.register_opcode(0x00, 0xFF, printresync)
 
 	def set_rawfile(self, filename):
 		self.lock.acquire()
 		self.rawfile = open(filename, "w") if filename else None
 		self.lock.release()
 
+	def set_formatter(self, itm_id):
+		"""Expect TPIU formatter frames, with ITM/DWT trace on itm_id.
+
+		If itm_id is None the formatter is assumed to be bypassed and
+		the stream is decoded directly.  Other sources added to the
+		deframer are kept, so they are still routed if the formatter is
+		enabled again.
+		"""
+		self.lock.acquire()
+		if self._itm_id is not None:
+			self.deframer.remove_source(self._itm_id)
+		if itm_id is not None:
+			if not self.formatter:
+				# Frame alignment from before is meaningless
+				self.deframer.reset()
+			self.deframer.add_source(itm_id, self)
+		self._itm_id = itm_id
+		self.formatter = itm_id is not None
+		self.lock.release()
+
+	def add_source(self, id, decoder):
+		"""Route another formatter trace source to its own decoder"""
+		if not self.formatter:
+			raise gdb.GdbError("TPIU formatter is not enabled")
+		self.lock.acquire()
+		self.deframer.add_source(id, decoder)
+		self.lock.release()
+
+	def remove_source(self, id):
+		self.lock.acquire()
+		self.deframer.remove_source(id)
+		self.lock.release()
+
+	def start_server(self, address, maxlen=256):
+		"""Publish decoded events on a local socket, see TraceServer"""
+		self.stop_server()
+		try:
+			self.server = TraceServer(address, maxlen)
+		except (socket.error, OSError, ValueError) as e:
+			raise gdb.GdbError("Can't serve trace on %s: %s" % (address, e))
+		self.server.start()
+		self._serversub = self.subscribe(self.server.publish, batch=True,
+				gdb_thread=False)
+
+	def stop_server(self):
+		if self.server:
+			self.unsubscribe(self._serversub)
+			self.server.stop()
+			self.server = None
+			self._serversub = None
+
 	def pause(self):
 		self.lock.acquire()
 		self._pause = True
@@ -76,6 +140,32 @@ class TPACapture(threading.Thread, TPADecoder):
 		TPADecoder.register_opcode(self, code, mask, op_proxy, *args)
 		self.lock.release()
 
+	def subscribe(self, callback=None, types=None, batch=False,
+			maxlen=None, gdb_thread=True):
+		"""Subscribe to decoded events.  Callbacks are run from the GDB
+		event loop unless gdb_thread is False, in which case they are run
+		on the capture thread and must not call into GDB."""
+		self.lock.acquire()
+		if callback and gdb_thread:
+			# Post each batch as a single GDB event
+			if batch:
+				proxy = lambda events: gdb.post_event(
+						lambda: callback(events))
+			else:
+				proxy = lambda events: gdb.post_event(
+						lambda: [callback(e) for e in events])
+			sub = TPADecoder.subscribe(self, proxy, types, True, maxlen)
+		else:
+			sub = TPADecoder.subscribe(self, callback, types, batch,
+					maxlen)
+		self.lock.release()
+		return sub
+
+	def unsubscribe(self, sub):
+		self.lock.acquire()
+		TPADecoder.unsubscribe(self, sub)
+		self.lock.release()
+
 	def unregister_opcode(self, code, mask):
 		self.lock.acquire()
 		TPADecoder.unregister_opcode(self, code, mask)
@@ -85,14 +175,24 @@ class TPACapture(threading.Thread, TPADecoder):
 		while True:
 			try:
 				data = self.endp.read(256)
-			except usb.core.USBError:
+			except usb.core.USBError as e:
+				if e.errno != errno.ETIMEDOUT:
+					# Data was lost, the stream must be resynchronised
+					self.lock.acquire()
+					self.lose_sync()
+					if self.formatter:
+						self.deframer.reset()
+					self.lock.release()
 				continue
 
 			self.lock.acquire()
 			if self.rawfile:
 				self.rawfile.write(data.tostring())
 				self.rawfile.flush()
-			self.decode(data)
+			if self.formatter:
+				self.deframer.decode(data)
+			else:
+				self.decode(data)
 			self.lock.release()
 
 # Enable SWO capture and start capture/decoder thread
@@ -18,8 +18,18 @@
 
 import time
 
+from tpaevents import make_event, Subscription, TimestampEvent
+
+# At least 47 zero bits followed by a one
+SYNC = bytearray(b'\x00\x00\x00\x00\x00\x80')
+
 class TPADecoder(object):
-	"""Decoder state machine for unformatted trace port"""
+	"""Decoder state machine for unformatted trace port.
+
+	Capture may start part way through a packet, so nothing is decoded
+	until the first synchronisation packet is seen.  The ITM sends these
+	periodically, see DWT_CTRL_SYNCTAP in armv7m.py.
+	"""
 	siztab = (0, 1, 2, 4)
 	IDLE = 0
 	WAIT_SIZE = 1
@@ -27,16 +37,40 @@ class TPADecoder(object):
 
 	def __init__(self):
 		self._state = TPADecoder.IDLE
-		self._opcodes = [
-			(0x00, 0xFF, TPADecoder._sync, ())
-		]
+		self._opcodes = []
 		self._pause = True
 		self._timehold = False
+		self.time = 0
 		self._queue = []
+		self._subscribers = []
+		self._events = []
+		self._zeros = 0
+		self._syncbuf = bytearray()
+		self.synced = False
+		self.stats = {
+			'syncs': 0,
+			'resyncs': 0,
+			'lost_sync': 0,
+			'overflows': 0,
+			'invalid': 0,
+			'discarded': 0,
+			'skipped': 0,
+		}
 
 	def register_opcode(self, code, mask, func, *args):
 		self._opcodes.append((code, mask, func, args))
 
+	def subscribe(self, callback=None, types=None, batch=False,
+			maxlen=None):
+		"""Subscribe to decoded events of the given Event classes.
+		Returns the Subscription, see tpaevents.Subscription."""
+		sub = Subscription(callback, types, batch, maxlen)
+		self._subscribers.append(sub)
+		return sub
+
+	def unsubscribe(self, sub):
+		self._subscribers.remove(sub)
+
 	def unregister_opcode(self, code, mask):
 		for i in range(len(self._opcodes)):
 			if ((self._opcodes[i][0] == code) and
@@ -44,16 +78,115 @@ class TPADecoder(object):
 				del self._opcodes[i]
 				return
 
+	def pause(self):
+		self._pause = True
+
+	def resume(self):
+		self._pause = False
+
 	def hold_for_time(self, hold=True):
 		self._timehold = hold
 		self.time = 0 if hold else time.time()
 
+	def lose_sync(self):
+		"""Discard data until the next synchronisation packet, e.g. after
+		dropped data or an invalid packet header."""
+		if self.synced:
+			self.stats['lost_sync'] += 1
+		self.synced = False
+		self._state = TPADecoder.IDLE
+		self._zeros = 0
+		self._queue = []
+
+	def flush(self):
+		"""Deliver packets still waiting for a timestamp, e.g. at the
+		end of a trace file."""
+		for o, p in self._queue:
+			self._exec_opcode(o, p)
+		self._queue = []
+		self._deliver()
+
 	def decode(self, s):
-		for c in s:
+		s = bytearray(s)
+		while s:
+			if not self.synced:
+				s = self._find_sync(s)
+			elif self._pause:
+				s = s[self._skip(s):]
+			else:
+				s = s[self._parse(s):]
+		self._deliver()
+
+	def _deliver(self):
+		if self._events:
+			events, self._events = self._events, []
+			for sub in self._subscribers:
+				sub.deliver(events)
+
+	def _find_sync(self, s):
+		"""Scan for a sync packet, returning the data following it"""
+		buf = self._syncbuf + s
+		i = buf.find(SYNC)
+		if i < 0:
+			# Keep enough to match a sync split across transfers
+			keep = min(len(buf), len(SYNC) - 1)
+			self.stats['discarded'] += len(buf) - keep
+			self._syncbuf = buf[len(buf) - keep:]
+			return bytearray()
+
+		self._syncbuf = bytearray()
+		self.synced = True
+		self.stats['discarded'] += i
+		self.stats['resyncs'] += 1
+		if not self._pause:
+			# Report the resync to anything registered for opcode 0x00
+			self._exec_opcode(0x00, i)
+		return buf[i + len(SYNC):]
+
+	def _parse(self, s):
+		for i in range(len(s)):
+			self.decode_byte(s[i])
+			if not self.synced:
+				return i + 1
+		return len(s)
+
+	def _skip(self, s):
+		"""Follow packet boundaries without decoding, while paused"""
+		siztab = self.siztab
+		n = len(s)
+		i = 0
+		while i < n:
+			c = s[i]
+			if self._state == TPADecoder.IDLE and c & 3:
+				# Jump over whole source packets
+				end = i + 1 + siztab[c & 3]
+				if end <= n:
+					self._zeros = 0
+					i = end
+					continue
 			self.decode_byte(c)
+			i += 1
+			if not self.synced:
+				break
+		self.stats['skipped'] += i
+		return i
 
 	def decode_byte(self, c):
 		if self._state == TPADecoder.IDLE:
+			if c == 0x00:
+				self._zeros += 1
+				return
+			if c == 0x80 and self._zeros >= 5:
+				# Periodic synchronisation packet
+				self._zeros = 0
+				self.stats['syncs'] += 1
+				return
+			self._zeros = 0
+			if self._invalid_header(c):
+				# Packet boundaries have been lost
+				self.stats['invalid'] += 1
+				self.lose_sync()
+				return
 			if not self._timehold:
 				self.time = time.time()
 			self._opcode = c
@@ -66,6 +199,10 @@ class TPADecoder(object):
 				self._state = TPADecoder.WAIT_CONT
 				self._count = 0
 			else:
+				if c == 0x70:
+					# Overflow, packets were lost at the source but the
+					# stream is still aligned
+					self.stats['overflows'] += 1
 				self._push_opcode(c, None)
 		elif self._state == TPADecoder.WAIT_SIZE:
 			self._param += c << (8*self._count)
@@ -80,6 +217,10 @@ class TPADecoder(object):
 		else:
 			raise Exception("Invalid decoder state!")
 
+	def _invalid_header(self, c):
+		"""Reserved headers are never sent by the ITM"""
+		return (c & 0x0F) == 0x04 and c not in (0x94, 0xB4)
+
 	def _timestamp(self, opcode, val):
 		if opcode & 0xC0 == 0xC0:
 			# long format
@@ -103,17 +244,19 @@ class TPADecoder(object):
 			else:
 				# This is a timestamp, flush queue
 				self.time += ts
+				if self._subscribers:
+					self._events.append(TimestampEvent(self.time, ts))
 				for o, p in self._queue:
 					self._exec_opcode(o, p)
 				self._queue = []
 
 	def _exec_opcode(self, opcode, param):
 		#print "opcode %02X %s" % (opcode, param)
+		if self._subscribers:
+			ev = make_event(opcode, param, self.time)
+			if ev:
+				self._events.append(ev)
 		for t in self._opcodes:
 			if opcode & t[1] == t[0]:
 				t[2](self, opcode, param, *t[3])
 				return
-
-	def _sync(self, opcode, param):
-		pass
-
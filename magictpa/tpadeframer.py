@@ -0,0 +1,139 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+FRAME_SIZE = 16
+FULL_SYNC = bytearray(b'\xff\xff\xff\x7f')
+
+# Trace source IDs with special meaning
+ID_NULL = 0x00
+ID_TRIGGER = 0x7D
+
+class TPIUDeframer(object):
+	"""Split TPIU formatter frames into per-source trace streams.
+
+	Each 16-byte frame interleaves data from several trace sources,
+	identified by their ATB ID.  Data for each source is collected for the
+	whole buffer passed to decode() and then handed to the decoder
+	registered for that source in one call.
+	"""
+	def __init__(self):
+		self._sources = {}
+		self._buf = bytearray()
+		self._id = ID_NULL
+		self.synced = False
+		self.stats = {
+			'frames': 0,
+			'syncs': 0,
+			'lost_sync': 0,
+			'discarded': 0,
+		}
+		self.source_bytes = {}
+
+	def add_source(self, id, decoder):
+		"""Route data for trace source id to decoder.decode()"""
+		self._sources[id] = decoder
+		self.source_bytes.setdefault(id, 0)
+
+	def remove_source(self, id):
+		self._sources.pop(id, None)
+
+	def reset(self):
+		"""Forget frame alignment, e.g. after dropped data"""
+		if self.synced:
+			self.stats['lost_sync'] += 1
+		self.synced = False
+		self._buf = bytearray()
+		self._id = ID_NULL
+
+	def decode(self, s):
+		buf = self._buf + bytearray(s)
+		out = {}
+		i = 0
+
+		if not self.synced:
+			i = buf.find(FULL_SYNC)
+			if i < 0:
+				# Keep enough to match a sync split across transfers
+				keep = len(FULL_SYNC) - 1
+				self.stats['discarded'] += max(len(buf) - keep, 0)
+				self._buf = buf[-keep:]
+				return
+			self.stats['discarded'] += i
+			self.synced = True
+
+		n = len(buf)
+		while n - i >= len(FULL_SYNC):
+			# Full sync packets are only inserted between frames
+			if buf[i:i+4] == FULL_SYNC:
+				self.stats['syncs'] += 1
+				i += 4
+				continue
+			if n - i < FRAME_SIZE:
+				break
+			self._frame(buf[i:i+FRAME_SIZE], out)
+			i += FRAME_SIZE
+		self._buf = buf[i:]
+
+		for id, data in out.items():
+			dec = self._sources.get(id)
+			if dec is None:
+				if id not in (ID_NULL, ID_TRIGGER):
+					self.stats['discarded'] += len(data)
+				continue
+			self.source_bytes[id] += len(data)
+			dec.decode(data)
+
+	def _frame(self, f, out):
+		self.stats['frames'] += 1
+		aux = f[15]
+		cur = self._id
+
+		if not ((f[0] | f[2] | f[4] | f[6] | f[8] | f[10] | f[12] |
+				f[14]) & 1):
+			# No ID changes in this frame, just restore the data LSBs
+			d = f[:15]
+			for j in range(8):
+				d[2*j] = (d[2*j] & 0xFE) | ((aux >> j) & 1)
+			out.setdefault(cur, bytearray()).extend(d)
+			return
+
+		for j in range(8):
+			b = f[2*j]
+			odd = f[2*j+1] if j < 7 else None
+			if b & 1:
+				if (aux >> j) & 1 and odd is not None:
+					# ID change takes effect after the next byte
+					out.setdefault(cur, bytearray()).append(odd)
+					odd = None
+				cur = b >> 1
+			else:
+				out.setdefault(cur, bytearray()).append(
+					(b & 0xFE) | ((aux >> j) & 1))
+			if odd is not None:
+				out.setdefault(cur, bytearray()).append(odd)
+		self._id = cur
+
+	def __str__(self):
+		s = ("%s, %d frames, %d sync packets, %d times lost sync, "
+			"%d bytes discarded" % (
+			"synchronised" if self.synced else "not synchronised",
+			self.stats['frames'], self.stats['syncs'],
+			self.stats['lost_sync'], self.stats['discarded']))
+		for id, count in sorted(self.source_bytes.items()):
+			s += "\nSource 0x%02X: %d bytes" % (id, count)
+		return s
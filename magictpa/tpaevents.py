@@ -0,0 +1,166 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Typed events produced by the trace decoder."""
+
+import collections
+
+class Event(object):
+	__slots__ = ('time',)
+
+	def __init__(self, time):
+		self.time = time
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__, ", ".join(
+			"%s=%r" % (s, getattr(self, s)) for s in self._fields()))
+
+	@classmethod
+	def _fields(cls):
+		fields = []
+		for c in reversed(cls.__mro__):
+			fields.extend(getattr(c, '__slots__', ()))
+		return fields
+
+class StimulusEvent(Event):
+	"""Software write to an ITM stimulus port"""
+	__slots__ = ('channel', 'value', 'size')
+
+	def __init__(self, time, channel, value, size):
+		Event.__init__(self, time)
+		self.channel = channel
+		self.value = value
+		self.size = size
+
+class DataValueEvent(Event):
+	"""Data read or written at a DWT comparator match"""
+	__slots__ = ('comparator', 'write', 'value', 'size')
+
+	def __init__(self, time, comparator, write, value, size):
+		Event.__init__(self, time)
+		self.comparator = comparator
+		self.write = write
+		self.value = value
+		self.size = size
+
+class PCEvent(Event):
+	"""PC sampled at a DWT comparator match, or periodically if
+	comparator is None.  pc is None for samples taken while sleeping."""
+	__slots__ = ('comparator', 'pc')
+
+	def __init__(self, time, comparator, pc):
+		Event.__init__(self, time)
+		self.comparator = comparator
+		self.pc = pc
+
+class AddressEvent(Event):
+	"""Low 16 bits of the data address at a DWT comparator match"""
+	__slots__ = ('comparator', 'offset')
+
+	def __init__(self, time, comparator, offset):
+		Event.__init__(self, time)
+		self.comparator = comparator
+		self.offset = offset
+
+EXC_ENTERED = 1
+EXC_EXITED = 2
+EXC_RETURNED = 3
+
+class ExceptionEvent(Event):
+	"""Exception entry, exit or return"""
+	__slots__ = ('number', 'action')
+	names = {EXC_ENTERED: "entered", EXC_EXITED: "exited",
+		EXC_RETURNED: "returned to"}
+
+	def __init__(self, time, number, action):
+		Event.__init__(self, time)
+		self.number = number
+		self.action = action
+
+class TimestampEvent(Event):
+	"""Local timestamp, delta is in trace clock cycles"""
+	__slots__ = ('delta',)
+
+	def __init__(self, time, delta):
+		Event.__init__(self, time)
+		self.delta = delta
+
+class OverflowEvent(Event):
+	"""ITM output overflowed and packets were lost"""
+	__slots__ = ()
+
+siztab = (0, 1, 2, 4)
+
+def make_event(opcode, param, time):
+	"""Return the Event for a decoded packet, or None"""
+	if opcode & 3:
+		size = siztab[opcode & 3]
+		if not opcode & 4:
+			return StimulusEvent(time, opcode >> 3, param, size)
+		disc = opcode >> 3
+		if disc == 1:
+			return ExceptionEvent(time, param & 0x1FF, (param >> 12) & 3)
+		if disc == 2:
+			return PCEvent(time, None, param if size == 4 else None)
+		comp = (opcode >> 4) & 3
+		if opcode & 0xC0 == 0x80:
+			return DataValueEvent(time, comp, bool(opcode & 8), param, size)
+		if opcode & 0xC8 == 0x40:
+			return PCEvent(time, comp, param)
+		if opcode & 0xC8 == 0x48:
+			return AddressEvent(time, comp, param)
+		return None
+	if opcode == 0x70:
+		return OverflowEvent(time)
+	if opcode & 0xCF == 0xC0:
+		return TimestampEvent(time, param)
+	if opcode & 0x8F == 0 and opcode:
+		return TimestampEvent(time, opcode >> 4)
+	return None
+
+class Subscription(object):
+	"""A consumer of decoded trace events.
+
+	If callback is given it is called with each event, or with a list of
+	events per decoded buffer if batch is True.  Otherwise events are
+	queued, holding at most maxlen, and read by iterating over the
+	subscription.
+	"""
+	def __init__(self, callback=None, types=None, batch=False, maxlen=None):
+		self.callback = callback
+		self.types = types or Event
+		self.batch = batch
+		self._queue = collections.deque(maxlen=maxlen)
+
+	def deliver(self, events):
+		events = [e for e in events if isinstance(e, self.types)]
+		if not events:
+			return
+		if self.callback is None:
+			self._queue.extend(events)
+		elif self.batch:
+			self.callback(events)
+		else:
+			for e in events:
+				self.callback(e)
+
+	def __iter__(self):
+		"""Yield queued events until the queue is empty"""
+		q = self._queue
+		while q:
+			yield q.popleft()
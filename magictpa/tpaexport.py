@@ -0,0 +1,295 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming export of decoded trace to Chrome trace-event JSON and VCD.
+
+Exporters are batch callbacks for TPADecoder.subscribe() and write each
+event as it arrives, so memory use doesn't grow with the capture length.
+They don't use GDB and can also be run offline on a raw trace file:
+
+    python tpaexport.py (chrome|vcd) [--formatter] <raw> <out>
+
+Raw files don't record host time, so they can only be converted with the
+ITM's own timestamps, captured with 'set tpa time delta'.
+"""
+
+import json
+import sys
+
+from tpadecoder import TPADecoder
+from tpadeframer import TPIUDeframer
+from tpaevents import (StimulusEvent, DataValueEvent, AddressEvent,
+		ExceptionEvent, EXC_ENTERED, EXC_EXITED)
+
+# Flush partial stimulus lines longer than this
+MAX_LINE = 256
+
+class TraceExporter(object):
+	"""Base class for exporters.
+
+	names maps a DWT comparator number, or a (comparator, address offset)
+	pair for comparators shared between variables, to a signal name.
+	formats maps signal names to value formatters from valuefmt.py, so
+	signed, float, enum and pointer values are exported as numbers
+	rather than raw data words.
+	"""
+	types = (StimulusEvent, DataValueEvent, AddressEvent, ExceptionEvent)
+
+	def __init__(self, f, names=None, formats=None):
+		self._f = f
+		self.names = names or {}
+		self.formats = formats or {}
+		self._t0 = None
+		self._offset = {}
+		self._stimbuf = {}
+
+	def __call__(self, events):
+		for ev in events:
+			if isinstance(ev, AddressEvent):
+				self._offset[ev.comparator] = ev.offset
+			elif isinstance(ev, DataValueEvent):
+				off = self._offset.pop(ev.comparator, None)
+				name = self.signal(ev.comparator, off)
+				self.value(ev.time, name, self.number(name, ev.value))
+			elif isinstance(ev, ExceptionEvent):
+				self.exception(ev.time, ev.number, ev.action)
+			elif isinstance(ev, StimulusEvent):
+				self._stimulus(ev)
+
+	def signal(self, comp, offset=None):
+		name = self.names.get((comp, offset))
+		if name is None:
+			name = self.names.get(comp, "dwt%d" % comp)
+			if offset is not None:
+				name = "%s@%04X" % (name, offset)
+		return name
+
+	def number(self, name, value):
+		"""Numeric value of a data word using the signal's formatter.
+		Values the formatter can't show as a number, such as enum
+		names, are left as the raw word."""
+		fmt = self.formats.get(name)
+		if fmt is None:
+			return value
+		s = fmt(value)
+		try:
+			return int(s)
+		except ValueError:
+			pass
+		try:
+			return float(s)
+		except ValueError:
+			return value
+
+	def _stimulus(self, ev):
+		buf = self._stimbuf.get(ev.channel, '')
+		for i in range(ev.size):
+			c = chr((ev.value >> (8 * i)) & 0xFF)
+			if c == '\n' or len(buf) >= MAX_LINE:
+				self.line(ev.time, ev.channel, buf)
+				buf = ''
+			if c != '\n':
+				buf += c
+		self._stimbuf[ev.channel] = buf
+
+	def ticks(self, time):
+		"""Convert event time to microseconds, or cycles for delta
+		timestamps, relative to the first event"""
+		if self._t0 is None:
+			self._t0 = time
+		if type(time) is float:
+			return int((time - self._t0) * 1e6)
+		return time - self._t0
+
+	def value(self, time, name, value):
+		pass
+
+	def exception(self, time, number, action):
+		pass
+
+	def line(self, time, channel, text):
+		pass
+
+	def close(self):
+		self._f.close()
+
+class ChromeTraceExporter(TraceExporter):
+	"""Chrome trace-event JSON, as read by Perfetto and chrome://tracing.
+	Exceptions are duration slices, variables are counter tracks and
+	stimulus lines are instant events."""
+	def __init__(self, f, names=None, formats=None):
+		TraceExporter.__init__(self, f, names, formats)
+		self._f.write("[\n")
+		self._sep = ""
+
+	def _write(self, ev):
+		self._f.write(self._sep + json.dumps(ev, separators=(',', ':')))
+		self._sep = ",\n"
+
+	def value(self, time, name, value):
+		self._write({"name": name, "ph": "C", "ts": self.ticks(time),
+			"pid": 0, "args": {"value": value}})
+
+	def exception(self, time, number, action):
+		if action == EXC_ENTERED:
+			ph = "B"
+		elif action == EXC_EXITED:
+			ph = "E"
+		else:
+			return
+		self._write({"name": "exception %d" % number, "ph": ph,
+			"ts": self.ticks(time), "pid": 0, "tid": 0})
+
+	def line(self, time, channel, text):
+		if isinstance(text, bytes):
+			text = text.decode('latin-1')
+		self._write({"name": text, "ph": "i", "s": "g",
+			"ts": self.ticks(time), "pid": 0, "tid": 1,
+			"args": {"channel": channel}})
+
+	def close(self):
+		self._f.write("\n]\n")
+		TraceExporter.close(self)
+
+class VCDExporter(TraceExporter):
+	"""Value change dump for waveform viewers.  Each named variable, or
+	each comparator if none are named, and the active exception number
+	are signals.  Signals must be declared before the first value change,
+	so data from unnamed (comparator, offset) pairs is shown on the
+	comparator's signal.  Signals with a formatter are real valued."""
+	def __init__(self, f, names=None, formats=None, ncomp=4):
+		TraceExporter.__init__(self, f, names, formats)
+		signals = sorted(set(self.names.values())) or \
+			["dwt%d" % i for i in range(ncomp)]
+		self._ids = {}
+		for i, name in enumerate(signals + ["exception"]):
+			self._ids[name] = self._id(i)
+		self._header = False
+		self._time = None
+		self._exc = [0]
+
+	def _id(self, i):
+		s = ''
+		while True:
+			s += chr(33 + i % 94)
+			i //= 94
+			if not i:
+				return s
+
+	def _write_header(self, time):
+		f = self._f
+		if type(time) is float:
+			f.write("$timescale 1 us $end\n")
+		else:
+			f.write("$comment times are trace clock cycles $end\n")
+			f.write("$timescale 1 ns $end\n")
+		f.write("$scope module trace $end\n")
+		for name, id in sorted(self._ids.items()):
+			if name in self.formats:
+				var = "real 64"
+			else:
+				var = "wire %d" % (9 if name == "exception" else 32)
+			f.write("$var %s %s %s $end\n" % (var, id,
+				name.replace(' ', '_')))
+		f.write("$upscope $end\n$enddefinitions $end\n")
+		self._header = True
+
+	def _change(self, time, name, value):
+		if not self._header:
+			self._write_header(time)
+		t = self.ticks(time)
+		# Host timestamps aren't guaranteed to be monotonic
+		if self._time is None or t > self._time:
+			self._time = t
+			self._f.write("#%d\n" % t)
+		if name in self.formats:
+			self._f.write("r%.16g %s\n" % (value, self._ids[name]))
+		else:
+			self._f.write("b%s %s\n" % (bin(value & 0xFFFFFFFF)[2:],
+				self._ids[name]))
+
+	def signal(self, comp, offset=None):
+		name = TraceExporter.signal(self, comp, offset)
+		if name not in self._ids:
+			name = TraceExporter.signal(self, comp)
+		return name
+
+	def value(self, time, name, value):
+		if name in self._ids:
+			self._change(time, name, value)
+
+	def exception(self, time, number, action):
+		# Track nesting so the signal shows the active exception
+		if action == EXC_ENTERED:
+			self._exc.append(number)
+		elif action == EXC_EXITED and len(self._exc) > 1:
+			self._exc.pop()
+		else:
+			return
+		self._change(time, "exception", self._exc[-1])
+
+exporters = {
+	'chrome': ChromeTraceExporter,
+	'vcd': VCDExporter,
+}
+
+def export_rawfile(rawfile, exporter, formatter=None, blocksize=65536):
+	"""Decode a raw trace file through exporter, timed by the ITM's
+	local timestamps.  If formatter is set it is the ATB ID of ITM trace
+	in a TPIU formatted stream.  Returns False if the file has no
+	timestamps, in which case every event is exported at time zero."""
+	dec = TPADecoder()
+	dec.resume()
+	dec.hold_for_time(True)
+	dec.subscribe(exporter, exporter.types, batch=True)
+	src = dec
+	if formatter is not None:
+		src = TPIUDeframer()
+		src.add_source(formatter, dec)
+
+	f = open(rawfile, "rb")
+	try:
+		while True:
+			data = f.read(blocksize)
+			if not data:
+				break
+			src.decode(data)
+	finally:
+		f.close()
+	# Events after the last timestamp are still waiting for one
+	dec.flush()
+	exporter.close()
+	return dec.time != 0
+
+def main(argv):
+	args = [a for a in argv[1:] if not a.startswith('--')]
+	opts = [a for a in argv[1:] if a.startswith('--')]
+	if len(args) != 3 or args[0] not in exporters:
+		sys.stderr.write("usage: %s (%s) [--formatter] "
+			"<rawfile> <outfile>\n" % (argv[0], "|".join(exporters)))
+		return 1
+	exporter = exporters[args[0]](open(args[2], "w"))
+	# ITM trace uses ATB ID 1 when the formatter is enabled
+	if not export_rawfile(args[1], exporter,
+			1 if '--formatter' in opts else None):
+		sys.stderr.write("%s: no timestamps in trace, capture with "
+			"'set tpa time delta'\n" % args[1])
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
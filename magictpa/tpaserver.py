@@ -0,0 +1,212 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Publish decoded trace events to clients on a local socket.
+
+Each event is sent as one line of JSON, for example:
+    {"event":"Exception","time":1.5,"number":15,"action":1}
+
+Every client has its own bounded queue of event batches.  If a client
+doesn't keep up, its oldest batches are dropped so the capture thread is
+never blocked.
+"""
+
+import collections
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+import stat
+import threading
+
+def encode_events(events):
+	"""Encode a batch of events as JSON lines"""
+	lines = []
+	for ev in events:
+		d = {'event': ev.__class__.__name__[:-len('Event')]}
+		for f in ev._fields():
+			d[f] = getattr(ev, f)
+		lines.append(json.dumps(d, separators=(',', ':')))
+	lines.append('')
+	return '\n'.join(lines).encode()
+
+class TraceClient(object):
+	def __init__(self, sock, addr, maxlen):
+		self.sock = sock
+		self.addr = addr
+		self.queue = collections.deque(maxlen=maxlen)
+		self.pending = b''
+		self.dropped = 0
+
+	def __str__(self):
+		return "%s: %d batches queued, %d dropped" % (self.addr or "unix",
+			len(self.queue), self.dropped)
+
+class TraceServer(threading.Thread):
+	"""Serve decoded events on a Unix socket path, or a TCP port on the
+	loopback interface if address is an integer."""
+	def __init__(self, address, maxlen=256):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.address = address
+		self.maxlen = maxlen
+		self.clients = []
+		self.lock = threading.Lock()
+		self._stopping = False
+		self._inode = None
+
+		if isinstance(address, int):
+			self._listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self._listen.setsockopt(socket.SOL_SOCKET,
+				socket.SO_REUSEADDR, 1)
+			address = ('127.0.0.1', address)
+		else:
+			if os.path.exists(address):
+				# Only replace a stale socket, never a regular file
+				if not stat.S_ISSOCK(os.stat(address).st_mode):
+					raise ValueError("%s exists and is not a socket" %
+						address)
+				os.unlink(address)
+			self._listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self._listen.bind(address)
+			self._listen.listen(5)
+		except socket.error:
+			self._listen.close()
+			raise
+		if not isinstance(self.address, int):
+			# Remember which socket is ours, the path may be reused
+			self._inode = os.stat(self.address).st_ino
+		# publish() must never block the capture thread, so a full pipe
+		# just means a wake up is already pending.
+		self._wake_r, self._wake_w = os.pipe()
+		for fd in (self._wake_r, self._wake_w):
+			fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+	def publish(self, events):
+		"""Queue a batch of events for all clients.  Called from the
+		capture thread, never blocks on a client."""
+		if not self.clients:
+			return
+		data = encode_events(events)
+		self.lock.acquire()
+		for c in self.clients:
+			if len(c.queue) == c.queue.maxlen:
+				c.dropped += 1
+			c.queue.append(data)
+		self.lock.release()
+		self._wake()
+
+	def _wake(self):
+		try:
+			os.write(self._wake_w, b'x')
+		except OSError:
+			pass
+
+	def stop(self, timeout=1.0):
+		"""Stop serving and wait for the sockets to be closed, so the
+		address can be used again straight away."""
+		self._stopping = True
+		self._wake()
+		if self.is_alive():
+			self.join(timeout)
+
+	def run(self):
+		try:
+			while not self._stopping:
+				self._poll()
+		finally:
+			for c in self.clients:
+				c.sock.close()
+			self._listen.close()
+			os.close(self._wake_r)
+			os.close(self._wake_w)
+			if self._inode is not None:
+				try:
+					if os.stat(self.address).st_ino == self._inode:
+						os.unlink(self.address)
+				except OSError:
+					pass
+
+	def _poll(self):
+		self.lock.acquire()
+		clients = list(self.clients)
+		writers = [c.sock for c in clients if c.pending or c.queue]
+		self.lock.release()
+		readers = [self._listen, self._wake_r] + [c.sock for c in clients]
+		r, w, x = select.select(readers, writers, [])
+
+		if self._wake_r in r:
+			try:
+				os.read(self._wake_r, 4096)
+			except OSError:
+				pass
+		if self._listen in r:
+			sock, addr = self._listen.accept()
+			sock.setblocking(False)
+			self.lock.acquire()
+			self.clients.append(TraceClient(sock, addr, self.maxlen))
+			self.lock.release()
+
+		for c in clients:
+			if c.sock in r:
+				# Clients aren't expected to send anything, so this is
+				# either junk to discard or the connection closing.
+				try:
+					if not c.sock.recv(4096):
+						self._drop(c)
+						continue
+				except socket.error:
+					self._drop(c)
+					continue
+			if c.sock in w:
+				self._send(c)
+
+	def _send(self, c):
+		if not c.pending:
+			self.lock.acquire()
+			c.pending = b''.join(c.queue)
+			c.queue.clear()
+			self.lock.release()
+		try:
+			n = c.sock.send(c.pending)
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				self._drop(c)
+			return
+		c.pending = c.pending[n:]
+
+	def _drop(self, c):
+		self.lock.acquire()
+		self.clients.remove(c)
+		self.lock.release()
+		c.sock.close()
+
+	def __str__(self):
+		if isinstance(self.address, int):
+			s = "Serving trace on 127.0.0.1:%d" % self.address
+		else:
+			s = "Serving trace on %s" % self.address
+		self.lock.acquire()
+		for c in self.clients:
+			s += "\n" + str(c)
+		self.lock.release()
+		return s
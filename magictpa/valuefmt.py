@@ -0,0 +1,145 @@
+# This file is part of the Magic TPA project.
+#
+# Copyright (C) 2013  Black Sphere Technologies Ltd.
+# Written by Gareth McMullin <gareth@blacksphere.co.nz>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Formatters for raw data values captured from DWT comparators.
+
+A formatter is built once from a gdb.Type when a watch is created.  The
+returned callable only uses struct and dict lookups, so it is safe to call
+from the capture thread without going through GDB.
+"""
+
+import gdb
+import struct
+
+from elfmap import symbol_table
+
+def _symbol_table():
+	"""Map addresses of global and static symbols to their names.
+
+	Symbols are read from the ELF file of each objfile and cached per file,
+	so reloading the program picks up the new symbols.
+	"""
+	symtab = {}
+	for objfile in gdb.objfiles():
+		if not objfile.filename:
+			continue
+		try:
+			symtab.update(symbol_table(objfile.filename))
+		except (IOError, OSError, ValueError, struct.error):
+			continue
+	return symtab
+
+def _is_signed(t):
+	try:
+		return gdb.Value(-1).cast(t) < 0
+	except gdb.error:
+		return False
+
+def int_formatter(size, signed):
+	mask = (1 << (8 * size)) - 1
+	sign = 1 << (8 * size - 1)
+	if not signed:
+		return lambda v: str(v & mask)
+	def fmt(v):
+		v &= mask
+		if v & sign:
+			v -= mask + 1
+		return str(v)
+	return fmt
+
+def float_formatter(size):
+	if size != 4:
+		# Doubles don't fit in a single DWT data value packet.
+		return lambda v: "0x%08X" % v
+	return lambda v: "%g" % struct.unpack("<f", struct.pack("<L", v))[0]
+
+def enum_formatter(size, names):
+	mask = (1 << (8 * size)) - 1
+	def fmt(v):
+		v &= mask
+		return names.get(v, str(v))
+	return fmt
+
+def pointer_formatter(size, symbols):
+	mask = (1 << (8 * size)) - 1
+	def fmt(v):
+		v &= mask
+		sym = symbols.get(v)
+		if not sym and v & 1:
+			# Function pointers have the Thumb bit set
+			sym = symbols.get(v & ~1)
+		if sym:
+			return "0x%08X <%s>" % (v, sym)
+		return "0x%08X" % v
+	return fmt
+
+def value_formatter(vartype):
+	"""Return a callable formatting a raw value of the given gdb.Type"""
+	t = vartype.strip_typedefs()
+	size = t.sizeof
+	code = t.code
+
+	if code == gdb.TYPE_CODE_FLT:
+		return float_formatter(size)
+
+	if code == gdb.TYPE_CODE_ENUM:
+		names = {}
+		for f in t.fields():
+			# Older GDB stores the enumerator value in bitpos.
+			val = f.enumval if hasattr(f, 'enumval') else f.bitpos
+			names[val & ((1 << (8 * size)) - 1)] = f.name
+		return enum_formatter(size, names)
+
+	if code == gdb.TYPE_CODE_PTR:
+		return pointer_formatter(size, _symbol_table())
+
+	if code == gdb.TYPE_CODE_BOOL:
+		return lambda v: "true" if v else "false"
+
+	if code in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_CHAR):
+		return int_formatter(size, _is_signed(t))
+
+	# Structs, arrays and anything else are shown as raw words.
+	return lambda v: "0x%X" % v
+
+def field_formatters(name, vartype, offset=0, fields=None):
+	"""Map byte offsets within a variable to (name, formatter) pairs.
+
+	Structs and arrays are expanded so values captured from a comparator
+	covering the whole variable can be attributed to individual members.
+	"""
+	if fields is None:
+		fields = {}
+	t = vartype.strip_typedefs()
+
+	if t.code == gdb.TYPE_CODE_STRUCT:
+		for f in t.fields():
+			if f.bitsize or not hasattr(f, 'bitpos'):
+				# Bitfields and static members can't be matched by offset
+				continue
+			field_formatters("%s.%s" % (name, f.name), f.type,
+				offset + f.bitpos // 8, fields)
+	elif t.code == gdb.TYPE_CODE_ARRAY:
+		elem = t.target()
+		lo, hi = t.range()
+		for i in range(lo, hi + 1):
+			field_formatters("%s[%d]" % (name, i), elem,
+				offset + (i - lo) * elem.sizeof, fields)
+	else:
+		fields[offset] = (name, value_formatter(t))
+	return fields